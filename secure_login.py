@@ -5,79 +5,259 @@ import time
 import secrets
 import hmac
 import base64
-import struct
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from getpass import getpass
+from pathlib import Path
+
+# PBKDF2-HMAC-SHA256 work factor for newly hashed passwords
+PBKDF2_ITERATIONS = 200_000
+
+# Stored password hashes are SALT_SIZE bytes of salt followed by the digest
+SALT_SIZE = 16
+DIGEST_SIZE = 32
+
+# Number of 30-second steps of clock drift accepted either side of now
+TOTP_WINDOW = 1
+
+# Read-only connections kept open for login and user listing
+READER_POOL_SIZE = 4
+
+# HOTP only needs SHA-1 inside HMAC, not as a standalone hash, so mark it
+# as not security-relevant for FIPS-restricted OpenSSL builds
+hotp_sha1 = partial(hashlib.sha1, usedforsecurity=False)
+
+def hmac_sha1_batch(keyed_hmac, messages):
+    """Compute HMAC-SHA1 of several messages from one keyed HMAC state.
+    
+    All TOTP window codes go through this one call, so a multi-buffer
+    SHA-1 backend can be dropped in here without touching the callers.
+    """
+    copy = keyed_hmac.copy
+    digests = []
+    for message in messages:
+        h = copy()
+        h.update(message)
+        digests.append(h.digest())
+    return digests
 
 class SecureLoginSystem:
+    # Recurring statements, kept in one place so every caller uses the same SQL
+    SELECT_USER_SQL = (
+        "SELECT password_hash, password_iterations, two_factor_enabled "
+        "FROM users WHERE username = ?"
+    )
+    SELECT_2FA_SECRET_SQL = "SELECT two_factor_secret FROM users WHERE username = ?"
+    BULK_INSERT_USER_SQL = (
+        "INSERT INTO users (username, password_hash, password_iterations, two_factor_enabled) "
+        "VALUES (?, ?, ?, 0) "
+        "ON CONFLICT(username) DO NOTHING"
+    )
+    INSERT_USER_SQL = BULK_INSERT_USER_SQL + " RETURNING id"
+    UPDATE_PASSWORD_SQL = (
+        "UPDATE users SET password_hash = ?, password_iterations = ? WHERE username = ?"
+    )
+    UPDATE_2FA_SQL = "UPDATE users SET two_factor_enabled = 1, two_factor_secret = ? WHERE username = ?"
+    SELECT_USERS_SQL = "SELECT id, username, two_factor_enabled FROM users"
+    
     def __init__(self, db_name="secure_users.db"):
         """Initialize the login system with a database connection."""
-        self.conn = sqlite3.connect(db_name)
+        # A single writer connection handles every INSERT/UPDATE; it may be
+        # used from any thread, so every use of conn/cursor holds the lock
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self._write_lock = threading.Lock()
         self.create_tables()
+        
+        # In WAL mode readers don't block the writer, so SELECTs go through
+        # a pool of read-only connections that any thread can borrow.
+        # In-memory and temporary databases can't be reopened by other
+        # connections, so their reads stay on the writer
+        self._readers = None
+        if db_name not in (":memory:", ""):
+            reader_uri = f"{Path(db_name).resolve().as_uri()}?mode=ro"
+            self._readers = queue.Queue()
+            for _ in range(READER_POOL_SIZE):
+                self._readers.put(
+                    sqlite3.connect(reader_uri, uri=True, check_same_thread=False)
+                )
         self.current_user = None
         
+        # The inner/outer HMAC pads depend only on the key, so each secret's
+        # keyed state is built once; the LRU bounds how many stay in memory
+        self.keyed_hmac = lru_cache(maxsize=1024)(self._keyed_hmac)
+        
+        # A code depends only on (secret, counter), so repeat checks within
+        # the same 30-second slot reuse it; old slots age out of the LRU
+        self.totp_for_counter = lru_cache(maxsize=4096)(self._totp_for_counter)
+        
     def create_tables(self):
         """Create necessary database tables if they don't exist."""
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            password_salt TEXT NOT NULL,
-            two_factor_enabled INTEGER DEFAULT 0,
-            two_factor_secret TEXT
-        )
-        ''')
-        self.conn.commit()
+        with self._write_lock:
+            # WAL with NORMAL sync avoids an fsync of the main file on every commit
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            self.cursor.execute("PRAGMA synchronous=NORMAL")
+            self.cursor.execute("PRAGMA temp_store=MEMORY")
+            self.cursor.execute("PRAGMA cache_size=-8000")
+            
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password_hash BLOB NOT NULL,
+                password_iterations INTEGER NOT NULL DEFAULT 0,
+                two_factor_enabled INTEGER DEFAULT 0,
+                two_factor_secret BLOB
+            )
+            ''')
+            
+            # Databases created before PBKDF2 have no iterations column;
+            # their rows keep 0 and are treated as legacy SHA-256 hashes
+            self.cursor.execute("PRAGMA table_info(users)")
+            columns = [column[1] for column in self.cursor.fetchall()]
+            if "password_iterations" not in columns:
+                self.cursor.execute(
+                    "ALTER TABLE users ADD COLUMN password_iterations INTEGER NOT NULL DEFAULT 0"
+                )
+                
+            # Salts used to live in their own column; fold them into password_hash.
+            # Legacy SHA-256 rows hold hex text, where the salt was the hex string itself
+            if "password_salt" in columns:
+                self.cursor.execute("SELECT id, password_hash, password_salt FROM users")
+                merged = []
+                for user_id, password_hash, salt in self.cursor.fetchall():
+                    if isinstance(password_hash, str):
+                        merged.append((salt.encode() + bytes.fromhex(password_hash), user_id))
+                    else:
+                        merged.append((salt + password_hash, user_id))
+                self.cursor.executemany("UPDATE users SET password_hash = ? WHERE id = ?", merged)
+                self.cursor.execute("ALTER TABLE users DROP COLUMN password_salt")
+                
+            # TOTP secrets used to be stored base32-encoded; decode them once here
+            self.cursor.execute("SELECT id, two_factor_secret FROM users WHERE typeof(two_factor_secret) = 'text'")
+            decoded = [(base64.b32decode(secret, True), user_id) for user_id, secret in self.cursor.fetchall()]
+            self.cursor.executemany("UPDATE users SET two_factor_secret = ? WHERE id = ?", decoded)
+            self.conn.commit()
+            
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool."""
+        if self._readers is None:
+            with self._write_lock:
+                yield self.conn
+            return
+            
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+            
+    def hash_password(self, password, salt=None, iterations=PBKDF2_ITERATIONS):
+        """Hash a password with a salt using PBKDF2-HMAC-SHA256.
         
-    def hash_password(self, password, salt=None):
-        """Hash a password with a salt using SHA-256."""
+        Returns the salt followed by the digest, as stored in password_hash.
+        """
         if not salt:
-            salt = secrets.token_hex(16)
-        hash_obj = hashlib.sha256(salt.encode() + password.encode())
-        password_hash = hash_obj.hexdigest()
-        return password_hash, salt
+            salt = secrets.token_bytes(SALT_SIZE)
+        return salt + hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, dklen=DIGEST_SIZE)
+        
+    def hash_legacy_password(self, password, salt):
+        """Hash a password the pre-PBKDF2 way (single SHA-256 over salt+password)."""
+        hash_obj = hashlib.sha256(salt)
+        hash_obj.update(password.encode())
+        return salt + hash_obj.digest()
+        
+    def verify_password(self, password, password_hash, iterations):
+        """Check a password against a stored salt+digest in constant time."""
+        # Slice from the end: legacy SHA-256 rows carry a longer salt
+        salt = password_hash[:-DIGEST_SIZE]
+        if not iterations:
+            calculated_hash = self.hash_legacy_password(password, salt)
+        else:
+            calculated_hash = self.hash_password(password, salt, iterations)
+        return hmac.compare_digest(calculated_hash, password_hash)
         
     def register_user(self, username, password):
         """Register a new user with a hashed password."""
-        # Check if user already exists
-        self.cursor.execute("SELECT username FROM users WHERE username = ?", (username,))
-        if self.cursor.fetchone():
+        # Hash the password with a salt
+        password_hash = self.hash_password(password)
+        
+        # Insert the new user; no row comes back if the username is taken
+        with self._write_lock:
+            self.cursor.execute(self.INSERT_USER_SQL, (username, password_hash, PBKDF2_ITERATIONS))
+            inserted = self.cursor.fetchone()
+            self.conn.commit()
+        if not inserted:
             print("Username already exists!")
             return False
             
-        # Hash the password with a salt
-        password_hash, salt = self.hash_password(password)
-        
-        # Insert the new user into the database
-        self.cursor.execute(
-            "INSERT INTO users (username, password_hash, password_salt, two_factor_enabled) VALUES (?, ?, ?, 0)",
-            (username, password_hash, salt)
-        )
-        self.conn.commit()
         print(f"User {username} registered successfully!")
         return True
         
+    def register_users(self, credentials):
+        """Register many (username, password) pairs in a single transaction.
+        
+        Existing usernames are skipped. Returns the number of users added.
+        """
+        rows = []
+        for username, password in credentials:
+            rows.append((username, self.hash_password(password), PBKDF2_ITERATIONS))
+            
+        # One executemany inside one transaction means one commit for all rows
+        with self._write_lock:
+            with self.conn:
+                self.cursor.executemany(self.BULK_INSERT_USER_SQL, rows)
+            return self.cursor.rowcount
+        
+    def _keyed_hmac(self, secret):
+        """Build the HMAC-SHA1 state keyed with a TOTP secret (cached as keyed_hmac)."""
+        return hmac.new(secret, digestmod=hotp_sha1)
+        
+    def generate_totp_codes(self, secret, counters):
+        """Generate the TOTP codes for a list of counter values."""
+        counter_bytes = [counter.to_bytes(8, 'big') for counter in counters]
+        
+        # Create one HMAC-SHA1 hash per counter, keyed by the raw secret
+        hashes = hmac_sha1_batch(self.keyed_hmac(secret), counter_bytes)
+        
+        codes = []
+        for h in hashes:
+            # Extract a 4-byte dynamic binary code from the HMAC
+            offset = h[-1] & 0x0F
+            binary = int.from_bytes(h[offset:offset + 4], 'big') & 0x7FFFFFFF
+            
+            # Generate a 6-digit TOTP code
+            codes.append(f"{binary % 1000000:06d}")
+        return codes
+        
     def generate_totp_code(self, secret, time_step=30):
         """Generate a simple TOTP code."""
         # Get current timestamp and convert to counter value
         counter = int(time.time() // time_step)
-        counter_bytes = struct.pack('>Q', counter)
+        return self.totp_for_counter(secret, counter)
         
-        # Create HMAC-SHA1 hash
-        h = hmac.new(base64.b32decode(secret, True), counter_bytes, hashlib.sha1).digest()
+    def _totp_for_counter(self, secret, counter):
+        """Generate the TOTP code for one counter value (cached as totp_for_counter)."""
+        return self.generate_totp_codes(secret, [counter])[0]
         
-        # Extract a 4-byte dynamic binary code from the HMAC
-        offset = h[-1] & 0x0F
-        binary = ((h[offset] & 0x7F) << 24) | ((h[offset + 1] & 0xFF) << 16) | ((h[offset + 2] & 0xFF) << 8) | (h[offset + 3] & 0xFF)
-        
-        # Generate a 6-digit TOTP code
-        return str(binary % 1000000).zfill(6)
+    def verify_totp(self, secret, code, window=TOTP_WINDOW, time_step=30):
+        """Verify a TOTP code, allowing for `window` steps of clock drift."""
+        counter = int(time.time() // time_step)
+        expected_codes = [
+            self.totp_for_counter(secret, counter + step) for step in range(-window, window + 1)
+        ]
         
-    def verify_totp(self, secret, code):
-        """Verify a TOTP code."""
-        # Generate a code and compare
-        return self.generate_totp_code(secret) == code
+        # Compare as bytes so any user input is accepted, and check every
+        # code in constant time so timing doesn't reveal a match
+        provided = code.encode()
+        valid = False
+        for expected in expected_codes:
+            valid |= hmac.compare_digest(expected.encode(), provided)
+        return valid
         
     def enable_2fa(self, username):
         """Enable two-factor authentication for a user."""
@@ -86,17 +266,15 @@ class SecureLoginSystem:
             return None
             
         # Generate a secret key for TOTP
-        secret = base64.b32encode(os.urandom(10)).decode('utf-8')
+        secret = secrets.token_bytes(10)
         
         # Save the secret to the database
-        self.cursor.execute(
-            "UPDATE users SET two_factor_enabled = 1, two_factor_secret = ? WHERE username = ?",
-            (secret, username)
-        )
-        self.conn.commit()
+        with self._write_lock:
+            self.cursor.execute(self.UPDATE_2FA_SQL, (secret, username))
+            self.conn.commit()
         
         print("Two-factor authentication enabled!")
-        print(f"Your secret key: {secret}")
+        print(f"Your secret key: {base64.b32encode(secret).decode('ascii')}")
         print("Please store this key securely.")
         print(f"Your current TOTP code: {self.generate_totp_code(secret)}")
         print("This code will change every 30 seconds.")
@@ -105,30 +283,37 @@ class SecureLoginSystem:
     def login(self, username, password, totp_code=None):
         """Authenticate a user with password and optional 2FA."""
         # Get user from database
-        self.cursor.execute(
-            "SELECT password_hash, password_salt, two_factor_enabled, two_factor_secret FROM users WHERE username = ?", 
-            (username,)
-        )
-        user_data = self.cursor.fetchone()
+        with self.reader() as conn:
+            user_data = conn.execute(self.SELECT_USER_SQL, (username,)).fetchone()
         
         if not user_data:
             print("Invalid username or password.")
             return False
             
-        password_hash, salt, two_factor_enabled, two_factor_secret = user_data
+        password_hash, iterations, two_factor_enabled = user_data
         
         # Verify password
-        calculated_hash, _ = self.hash_password(password, salt)
-        if calculated_hash != password_hash:
+        if not self.verify_password(password, password_hash, iterations):
             print("Invalid username or password.")
             return False
             
+        # Upgrade legacy SHA-256 hashes now that we know the password
+        if iterations != PBKDF2_ITERATIONS:
+            password_hash = self.hash_password(password)
+            with self._write_lock:
+                self.cursor.execute(self.UPDATE_PASSWORD_SQL, (password_hash, PBKDF2_ITERATIONS, username))
+                self.conn.commit()
+            
         # Check if 2FA is enabled
         if two_factor_enabled:
             if not totp_code:
                 print("Two-factor authentication is required.")
                 return "2FA_REQUIRED"
                 
+            # Only 2FA users need the secret, so fetch it separately
+            with self.reader() as conn:
+                two_factor_secret = conn.execute(self.SELECT_2FA_SECRET_SQL, (username,)).fetchone()[0]
+            
             # Verify TOTP code
             if not self.verify_totp(two_factor_secret, totp_code):
                 print("Invalid two-factor code.")
@@ -138,6 +323,21 @@ class SecureLoginSystem:
         self.current_user = username
         return True
         
+    def verify_batch(self, username, passwords):
+        """Check several candidate passwords for one user without logging in.
+        
+        The stored hash is fetched once and every candidate is hashed with
+        the same salt and work factor. Returns one bool per candidate.
+        """
+        with self.reader() as conn:
+            user_data = conn.execute(self.SELECT_USER_SQL, (username,)).fetchone()
+        if not user_data:
+            return [False] * len(passwords)
+        
+        password_hash, iterations = user_data[:2]
+        verify = self.verify_password
+        return [verify(password, password_hash, iterations) for password in passwords]
+        
     def logout(self):
         """Log out the current user."""
         if self.current_user:
@@ -148,29 +348,45 @@ class SecureLoginSystem:
             
     def display_users(self):
         """Display all users in the database (for demonstration purposes)."""
-        self.cursor.execute("SELECT id, username, two_factor_enabled FROM users")
-        users = self.cursor.fetchall()
+        with self.reader() as conn:
+            users = conn.execute(self.SELECT_USERS_SQL).fetchall()
         
         if not users:
             print("No users registered.")
             return
             
-        headers = ["ID", "Username", "2FA Enabled"]
-        rows = [[user[0], user[1], "Yes" if user[2] else "No"] for user in users]
-        print("\nRegistered Users:")
-        print("-" * 40)
-        print(f"{'ID':<5}{'Username':<20}{'2FA Enabled':<10}")
-        print("-" * 40)
-        for row in rows:
-            print(f"{row[0]:<5}{row[1]:<20}{'Yes' if row[2] == 'Yes' else 'No':<10}")
+        # Build the whole table first and write it out in one call
+        lines = [
+            "\nRegistered Users:",
+            "-" * 40,
+            f"{'ID':<5}{'Username':<20}{'2FA Enabled':<10}",
+            "-" * 40,
+        ]
+        lines.extend(
+            f"{user_id:<5}{username:<20}{'Yes' if enabled else 'No':<10}"
+            for user_id, username, enabled in users
+        )
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
         
     def close(self):
-        """Close the database connection."""
-        self.conn.close()
+        """Close the database connections."""
+        # get() blocks until any reader still checked out is returned
+        if self._readers is not None:
+            for _ in range(READER_POOL_SIZE):
+                self._readers.get().close()
+        with self._write_lock:
+            self.conn.close()
 
 def clear_screen():
     """Clear the terminal screen."""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # Windows consoles don't process ANSI escapes unless VT mode is enabled
+    if os.name == 'nt':
+        os.system('cls')
+        return
+    # Erase the screen and home the cursor without spawning a shell
+    sys.stdout.write('\x1b[2J\x1b[H')
+    sys.stdout.flush()
 
 def main():
     login_system = SecureLoginSystem()